@@ -0,0 +1,26 @@
+#
+# A bounded queue which, when full, throws away everything queued and replaces
+# it with items asking for a full resync. One full sync supersedes
+# any number of queued per path updates, and memory stays bounded when the
+# consumer is stuck, e.g. on a hung rsync over a flaky link.
+
+import queue
+import logging
+
+class BoundedQueue(queue.Queue):
+    def putOrCollapse(self, item, *resync) -> None:
+        """ Put item without blocking, or collapse everything queued into the resync items """
+        try:
+            self.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        logging.warning("Queue full with %s items, collapsing to %s", self.qsize(), resync)
+        while True: # Only one producer per queue, so nothing refills it while draining
+            try:
+                self.get_nowait()
+                self.task_done()
+            except queue.Empty:
+                break
+        for fullSync in resync: self.put_nowait(fullSync)
@@ -0,0 +1,182 @@
+#
+# Use fanotify to watch whole directory trees with a single filesystem wide
+# mark, instead of an inotify watch on every subdirectory, and send the
+# notifications to a queue with the same (time, filename) items as INotify.
+#
+# Requires Linux >= 5.9 and CAP_SYS_ADMIN plus CAP_DAC_READ_SEARCH, so
+# watchTrees falls back to INotify when fanotify can not be used.
+
+from argparse import ArgumentParser
+import ctypes
+import struct
+import time
+import os
+import logging
+from TPWUtils.INotify import INotify
+from TPWUtils.Thread import Thread
+from BoundedQueue import BoundedQueue
+
+FAN_CLOEXEC = 0x00000001
+FAN_CLASS_NOTIF = 0x00000000
+FAN_REPORT_DFID_NAME = 0x00000c00 # FAN_REPORT_DIR_FID | FAN_REPORT_NAME
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_FILESYSTEM = 0x00000100
+FAN_ATTRIB = 0x00000004
+FAN_CLOSE_WRITE = 0x00000008
+FAN_MOVED_FROM = 0x00000040
+FAN_MOVED_TO = 0x00000080
+FAN_CREATE = 0x00000100
+FAN_DELETE = 0x00000200
+FAN_Q_OVERFLOW = 0x00004000
+FAN_ONDIR = 0x40000000
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+AT_FDCWD = -100
+
+_METADATA = struct.Struct("=IBBHQii") # struct fanotify_event_metadata
+_INFO_HEADER = struct.Struct("=BBH") # struct fanotify_event_info_header
+_FSID_LENGTH = 8 # __kernel_fsid_t
+_HANDLE_HEADER = struct.Struct("=Ii") # struct file_handle without f_handle
+_STATFS_HEAD = struct.Struct("@2l5Q") # struct statfs64 up to f_fsid
+_STATFS_SIZE = 256 # Bigger than struct statfs64 on any architecture
+
+_libc = None # Bound on first use, so a libc without these calls only disables fanotify
+
+def _bind() -> None:
+    global _libc
+    if _libc is not None: return
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        libc.fanotify_init.argtypes = (ctypes.c_uint, ctypes.c_uint)
+        libc.fanotify_mark.argtypes = (ctypes.c_int, ctypes.c_uint, ctypes.c_uint64,
+                                       ctypes.c_int, ctypes.c_char_p)
+        libc.open_by_handle_at.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int)
+        libc.fstatfs64.argtypes = (ctypes.c_int, ctypes.c_char_p)
+    except AttributeError as e: # e.g. musl >= 1.2.4 has no fstatfs64
+        raise OSError(f"libc is missing a fanotify call, {e}") from e
+    _libc = libc
+
+def _check(rc:int, what:str) -> int:
+    if rc < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{what}, {os.strerror(errno)}")
+    return rc
+
+def _fsid(fd:int) -> bytes:
+    """ The filesystem id of fd, as the raw bytes fanotify reports """
+    buffer = ctypes.create_string_buffer(_STATFS_SIZE)
+    _check(_libc.fstatfs64(fd, buffer), "fstatfs")
+    return buffer.raw[_STATFS_HEAD.size:_STATFS_HEAD.size + _FSID_LENGTH]
+
+class FANotify(Thread):
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.__init__(self, "FANotify", args)
+        _bind()
+        self.queue = BoundedQueue(args.queueMax)
+        self.__roots = [] # (resolved, as given) directories whose events are queued
+        self.__mountFDs = [] # (fsid, open directory) per root for open_by_handle_at
+        self.__flags = FAN_CLOSE_WRITE | FAN_ATTRIB | FAN_CREATE | FAN_DELETE \
+                | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_ONDIR
+        self.__fd = _check(
+                _libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC | FAN_REPORT_DFID_NAME,
+                                    os.O_RDONLY),
+                "fanotify_init")
+
+    def close(self) -> None:
+        """ Release the descriptors of a watcher which will not be started """
+        for (fsid, fd) in self.__mountFDs: os.close(fd)
+        self.__mountFDs = []
+        os.close(self.__fd)
+
+    def addTree(self, tgt:str) -> None:
+        tgt = os.path.abspath(os.path.expanduser(tgt))
+        fd = os.open(tgt, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fsid = _fsid(fd)
+            # One mark covers every directory on the filesystem holding tgt
+            _check(_libc.fanotify_mark(self.__fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM,
+                                       self.__flags, AT_FDCWD, os.fsencode(tgt)),
+                   "fanotify_mark " + tgt)
+        except:
+            os.close(fd)
+            raise
+        self.__roots.append((os.path.realpath(tgt), tgt))
+        self.__mountFDs.append((fsid, fd))
+        logging.info("Added filesystem mark for %s", tgt)
+
+    def __dirname(self, fsid:bytes, handle:bytes) -> str:
+        for (mountFSID, mountFD) in self.__mountFDs:
+            if mountFSID != fsid: continue # Handles are only unique within a filesystem
+            fd = _libc.open_by_handle_at(mountFD, handle, os.O_PATH | os.O_CLOEXEC)
+            if fd < 0: continue # Already gone
+            try:
+                return os.readlink(f"/proc/self/fd/{fd}")
+            finally:
+                os.close(fd)
+        return None
+
+    def __watched(self, fn:str) -> str:
+        # Map a resolved name back under the root as given, like INotify, or None if unwatched
+        for (real, root) in self.__roots:
+            if fn == real: return root
+            if fn.startswith(os.path.join(real, "")): return root + fn[len(real):]
+        return None
+
+    def __events(self, buffer:bytes):
+        offset = 0
+        while offset + _METADATA.size <= len(buffer):
+            (eventLen, vers, reserved, metaLen, mask, fd, pid) = \
+                    _METADATA.unpack_from(buffer, offset)
+            if fd >= 0: os.close(fd) # Not expected with FAN_REPORT_DFID_NAME
+            if mask & FAN_Q_OVERFLOW: # Events were dropped, and it carries no names
+                yield (mask, None, None, None)
+            info = offset + metaLen
+            end = offset + eventLen
+            while info + _INFO_HEADER.size <= end:
+                (infoType, pad, infoLen) = _INFO_HEADER.unpack_from(buffer, info)
+                if infoLen == 0: break
+                if infoType == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                    fsid = info + _INFO_HEADER.size
+                    hdr = fsid + _FSID_LENGTH
+                    (nBytes, handleType) = _HANDLE_HEADER.unpack_from(buffer, hdr)
+                    nameStart = hdr + _HANDLE_HEADER.size + nBytes
+                    name = buffer[nameStart:info + infoLen].split(b"\0", 1)[0]
+                    yield (mask, buffer[fsid:hdr], buffer[hdr:nameStart], os.fsdecode(name))
+                info += infoLen
+            offset = end
+
+    def runIt(self) -> None: # Called on thread start
+        logging.info("Starting loop")
+        while True:
+            buffer = os.read(self.__fd, 65536)
+            t0 = time.time() # Time of the events
+            resync = [(t0, root) for (real, root) in self.__roots] # Every tree
+            for (mask, fsid, handle, name) in self.__events(buffer):
+                if mask & FAN_Q_OVERFLOW:
+                    logging.warning("fanotify queue overflowed, resyncing every tree")
+                    for item in resync: self.queue.putOrCollapse(item, *resync)
+                    continue
+                dirname = self.__dirname(fsid, handle)
+                if dirname is None: continue
+                fn = dirname if name in ("", ".") else os.path.join(dirname, name)
+                fn = self.__watched(fn)
+                if fn is None: continue # Elsewhere on the filesystem
+                self.queue.putOrCollapse((t0, fn), *resync) # When full, resync every tree
+                logging.debug("Event %s", fn)
+
+def watchTrees(args:ArgumentParser, roots:list) -> Thread:
+    """ Start a watcher, with a queue of (time, filename), for the trees under roots """
+    if args.fanotify:
+        watcher = None
+        try:
+            watcher = FANotify(args)
+            for root in roots: watcher.addTree(root)
+            watcher.start()
+            return watcher
+        except OSError:
+            logging.exception("Unable to use fanotify, falling back to inotify")
+            if watcher is not None: watcher.close() # Don't leak what addTree opened
+
+    watcher = INotify(args)
+    watcher.start()
+    for root in roots: watcher.addTree(root)
+    return watcher
@@ -0,0 +1,60 @@
+#
+# Keep a set of paths as the minimal set of paths which cover them.
+#
+# Adding a path whose ancestor is already present is a no-op, and adding an
+# ancestor prunes any of its descendants, so each of the covering paths can be
+# synced on its own without rescanning unrelated siblings.
+
+import os.path
+
+def ancestors(path:str):
+    """ Yield path, then each of its parents up to the root """
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path: return
+        path = parent
+
+class PathTrie:
+    def __init__(self) -> None:
+        self.__root = {} # Nested dicts keyed by path component, None marks a covering path
+
+    def __bool__(self) -> bool:
+        return bool(self.__root)
+
+    @staticmethod
+    def __split(path:str) -> tuple:
+        return tuple(os.path.normpath(path).rstrip(os.sep).split(os.sep))
+
+    def __contains__(self, path:str) -> bool:
+        """ Is path, or one of its ancestors, present """
+        node = self.__root
+        for part in self.__split(path):
+            node = node.get(part, {})
+            if node is None: return True
+        return False
+
+    def add(self, path:str) -> bool:
+        """ Add path, returning False if it is already covered """
+        parts = self.__split(path)
+        node = self.__root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is None: return False # An ancestor already covers path
+        if parts[-1] in node and node[parts[-1]] is None: return False
+        node[parts[-1]] = None # Covers, and drops, any descendants
+        return True
+
+    def paths(self) -> list:
+        """ The minimal covering paths """
+        covers = []
+        stack = [((), self.__root)]
+        while stack:
+            (prefix, node) = stack.pop()
+            for (part, child) in node.items():
+                key = prefix + (part,)
+                if child is None:
+                    covers.append(os.sep.join(key) or os.sep)
+                else:
+                    stack.append((key, child))
+        return covers
@@ -0,0 +1,9 @@
+#
+# The records monitorRemote.py sends to syncit.py over ssh. Each is a directory
+# index and a length, followed by that many bytes of path relative to the
+# directory. Both ends use this module, so the format can not drift apart.
+
+import struct
+
+RECORD = struct.Struct("<HI") # Directory index and length of the path which follows
+MAX_RECORD = 65536 # Anything longer means the stream is out of step
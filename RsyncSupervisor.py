@@ -0,0 +1,122 @@
+#
+# Start rsyncs and read the output of every one in flight from a single thread,
+# instead of a thread per rsync blocked in communicate. A job is finished when
+# its rsync exits, not when its pipes close, since a child of rsync, e.g. an ssh
+# ControlMaster, may hold them open long after.
+
+from argparse import ArgumentParser
+import subprocess
+import threading
+import selectors
+import shlex
+import os
+import logging
+from concurrent.futures import Future
+from TPWUtils.Thread import Thread
+
+class RsyncSupervisor(Thread):
+    """ Start rsyncs and read the output of every one in flight from a single thread """
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.__init__(self, "RsyncSupervisor", args)
+        self.__semaphore = threading.BoundedSemaphore(max(1, args.rsyncMax))
+        self.__selector = selectors.DefaultSelector()
+        self.__lock = threading.Lock()
+        self.__pending = [] # Jobs to register, guarded by __lock
+        (self.__wakeRead, self.__wakeWrite) = os.pipe() # Interrupt select for new jobs
+        self.__selector.register(self.__wakeRead, selectors.EVENT_READ)
+
+    def execute(self, cmd:tuple, stdin:bytes=None) -> Future:
+        """ Start cmd, the Future's result is True when it succeeds """
+        # Only ask rsync for, and capture, its chatter when it will be logged.
+        # Otherwise stdout is discarded and only stderr is kept for failures.
+        verbose = self.args.verbose or self.args.debug
+        if verbose: cmd = (cmd[0], "--verbose", *cmd[1:])
+        self.__semaphore.acquire() # Bound how many rsyncs run at once
+        try:
+            # Keep close_fds, the inotify descriptor from libc is inheritable and would leak
+            # into every rsync. On Linux subprocess still vforks, without a preexec_fn,
+            # so this process's page tables are not copied for each rsync.
+            proc = subprocess.Popen(cmd,
+                                    shell=False,
+                                    stdin=None if stdin is None else subprocess.PIPE,
+                                    stdout=subprocess.PIPE if verbose else subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE,
+                                    )
+        except:
+            self.__semaphore.release()
+            raise
+        job = (cmd, proc, Future(), {}) # The dict maps each pipe to its output chunks
+        with self.__lock:
+            self.__pending.append(job)
+        os.write(self.__wakeWrite, b"\0")
+        if stdin is not None: # The supervisor is draining the output, so this can't deadlock
+            try:
+                try:
+                    proc.stdin.write(stdin)
+                finally:
+                    proc.stdin.close() # Flushes, so it can raise too, but always closes
+            except BrokenPipeError:
+                pass # rsync exited early, its status says why
+        return job[2]
+
+    def __finish(self, job:tuple) -> None:
+        (cmd, proc, future, output) = job
+        try:
+            for (pipe, chunks) in output.items():
+                if pipe.closed: continue
+                self.__selector.unregister(pipe)
+                try: # Take what rsync left in the pipe, without waiting on anyone else
+                    while True:
+                        data = os.read(pipe.fileno(), 65536)
+                        if not data: break
+                        chunks.append(data)
+                except BlockingIOError:
+                    pass # Still open in a child which outlived rsync, e.g. an ssh master
+                pipe.close()
+            proc.wait()
+            stdout = b"".join(output.get(proc.stdout, ()))
+            if proc.returncode:
+                logging.warning("Failed executing %s\n%s", shlex.join(cmd),
+                                str(b"".join(output[proc.stderr]), "utf-8", "replace"))
+            elif not logging.getLogger().isEnabledFor(logging.INFO):
+                pass # Don't join argv or decode output which would be thrown away
+            elif stdout:
+                logging.info("Executed: %s\n%s", shlex.join(cmd), str(stdout, "utf-8", "replace"))
+            else:
+                logging.info("Executed: %s", shlex.join(cmd))
+        finally: # Never strand a slot or a waiter
+            self.__semaphore.release()
+            future.set_result(proc.returncode == 0)
+
+    def runIt(self) -> None: # Called on start
+        selector = self.__selector
+        while True:
+            for (key, events) in selector.select():
+                if key.fileobj == self.__wakeRead:
+                    os.read(self.__wakeRead, 4096)
+                    with self.__lock:
+                        (pending, self.__pending) = (self.__pending, [])
+                    for job in pending:
+                        for pipe in (job[1].stdout, job[1].stderr):
+                            if pipe is None: continue
+                            job[3][pipe] = []
+                            os.set_blocking(pipe.fileno(), False)
+                            selector.register(pipe, selectors.EVENT_READ, job)
+                        # Readable when rsync exits, even if a child, e.g. an ssh master
+                        # started by ControlMaster=auto, keeps its pipes open
+                        selector.register(os.pidfd_open(job[1].pid), selectors.EVENT_READ, job)
+                    continue
+                job = key.data
+                if key.fileobj in job[3]: # One of rsync's pipes
+                    # Its exit may have come earlier in this select, and __finish closed it
+                    if key.fileobj.closed: continue
+                    data = os.read(key.fd, 65536) # Whatever is available, as it arrives
+                    if data:
+                        job[3][key.fileobj].append(data)
+                        continue
+                    selector.unregister(key.fileobj) # EOF
+                    key.fileobj.close()
+                    continue
+                selector.unregister(key.fd) # rsync exited
+                os.close(key.fd)
+                self.__finish(job)
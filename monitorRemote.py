@@ -1,50 +1,77 @@
 #! /usr/bin/env python3
 #
-# Monitor a directory tree for changes and spit them out
+# Monitor directory trees for changes and spit them out
 #
 # Resurrect and modernize code from SUNRISE-2019
 #
 # Nov-2024, Pat Welch, pat@mousebrains.com
 
 from argparse import ArgumentParser
-from TPWUtils.INotify import INotify
+import queue
+import sys
 import time
 import os.path
 import logging
 from TPWUtils import Logger
+from PathTrie import PathTrie, ancestors
+from FANotify import watchTrees
+from Record import RECORD
+
+def rootsOf(roots:dict, fn:str) -> list:
+    # Indices of every root holding fn
+    return [index for path in ancestors(fn) for index in roots.get(path, ())]
 
 parser = ArgumentParser()
 Logger.addArgs(parser)
-parser.add_argument("tgt", type=str, help="Directory to watch")
+parser.add_argument("tgt", type=str, nargs="+", help="Directories to watch")
 parser.add_argument("delay", type=float, help="Seconds after inotify before printing out")
+parser.add_argument("--queueMax", type=int, default=100000,
+                    help="Events queued before collapsing them into a full resync")
+parser.add_argument("--fanotify", action="store_true",
+                    help="Watch the tgts with one fanotify filesystem mark, instead of inotify watches")
 args = parser.parse_args()
 
 Logger.mkLogger(args)
 
 try:
-    tgt = os.path.abspath(os.path.expanduser(args.tgt))
+    tgts = [os.path.abspath(os.path.expanduser(tgt)) for tgt in args.tgt]
+    roots = {} # Root to the indices sent for it, spellings of one directory share a root
+    for (index, tgt) in enumerate(tgts): roots.setdefault(tgt, []).append(index)
     delay = args.delay
 
-    i = INotify(args)
-    i.start()
-    i.addTree(tgt)
-    q = i.queue
+    q = watchTrees(args, list(roots)).queue
 
     while True:
         (t0, fn) = q.get()
-        sources = set()
-        sources.add(fn if os.path.isdir(fn) else os.path.dirname(fn))
-        dt = max(0.1, t0 - time.time() + delay) # How long to sleep
-        logging.info("Modified %s sleeping for %s", fn, dt)
-        time.sleep(dt)
-        while not q.empty():
-            (t0, fn) = q.get()
-            q.task_done()
-            sources.add(fn if os.path.isdir(fn) else os.path.dirname(fn))
-        src = os.path.commonpath(sources)
-        path = os.path.relpath(src, start=tgt)
-        logging.info("Sending %s", path)
-        print(f":{path}", flush=True)
         q.task_done()
+        modified = {} # Root index to its unique names, so a burst on one file is one stat
+        deadline = max(t0 + delay, time.time() + 0.1) # When to send
+        logging.info("Modified %s collecting for %s", fn, deadline - time.time())
+        while True: # Debounce and drain in one, anything after the deadline is the next window
+            for index in rootsOf(roots, fn):
+                modified.setdefault(index, set()).add(fn)
+
+            remaining = deadline - time.time()
+            if remaining <= 0: break
+            try:
+                (t0, fn) = q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            q.task_done()
+
+        for index in modified:
+            tgt = tgts[index]
+            tgtLen = len(os.path.join(tgt, "")) # Strip to get a relative path
+            sources = PathTrie()
+            for fn in sorted(modified[index], key=len): # Shallowest first to cover deeper names
+                dirname = os.path.dirname(fn)
+                if dirname in sources: continue # Already covered whether fn is a dir or not
+                sources.add(fn if os.path.isdir(fn) else dirname)
+            for src in sources.paths(): # syncit.py pulls a window's covers in one rsync
+                path = "." if src == tgt else src[tgtLen:]
+                logging.info("Sending %s %s", tgt, path)
+                record = os.fsencode(path) # Raw bytes, no locale encoding
+                sys.stdout.buffer.write(RECORD.pack(index, len(record)) + record)
+            sys.stdout.buffer.flush()
 except:
     logging.exception("Unexpected exception")
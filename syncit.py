@@ -9,216 +9,323 @@
 from argparse import ArgumentParser
 import yaml
 import subprocess
+import asyncio
 import queue
+import threading
 import time
 import os.path
-import re
+import shlex
+import zlib
 import logging
+from concurrent.futures import Future
 from TPWUtils import Logger
-from TPWUtils.INotify import INotify
 from TPWUtils.Thread import Thread
+from PathTrie import PathTrie, ancestors
+from BoundedQueue import BoundedQueue
+from RsyncSupervisor import RsyncSupervisor
+from Record import RECORD, MAX_RECORD
+from FANotify import watchTrees
+
+def sshCommand(args:ArgumentParser, shared:bool=True) -> tuple:
+    # Share one TCP+SSH session per host between the remote monitor and all the rsyncs
+    if not args.controlPath: return (args.ssh,)
+    if not shared: return (args.ssh, "-o", "ControlPath=none") # A TCP flow of its own
+    return (
+            args.ssh,
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=" + args.controlPath,
+            "-o", f"ControlPersist={args.controlPersist}",
+            )
+
+def transferOptions(args:ArgumentParser) -> tuple:
+    # rsync options to resume interrupted transfers and save bandwidth on slow links
+    if args.inplace: # rsync rejects --inplace with --partial-dir, the file itself is the partial
+        opts = ["--inplace", "--partial"]
+    else: # Keep partial files out of the way, so nothing sees one under its real name
+        opts = ["--partial-dir=.rsync-partial"]
+    if args.bwlimit: opts.extend(("--bwlimit", args.bwlimit))
+    if args.compress:
+        opts.extend(("--compress",
+                     "--compress-choice=" + args.compress,
+                     f"--compress-level={args.compressLevel}"))
+    return tuple(opts)
+
+class PushRouter(Thread):
+    """ One watcher for every PushTo tree, routing each event to the trees it is in """
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.__init__(self, "PushRouter", args)
+        self.__trees = {} # Root directory to its PushTo's queue
+        self.__watcher = None
+
+    def add(self, dirRoot:str) -> BoundedQueue: # Called before start
+        return self.__trees.setdefault(dirRoot, BoundedQueue(self.args.queueMax))
+
+    def route(self, fn:str) -> list:
+        # Every tree holding fn, so nested trees each get the event
+        return [path for path in ancestors(fn) if path in self.__trees]
+
+    def watch(self) -> None: # Called after every add, before any PushTo starts
+        # Install the watches before the initial syncs, so nothing modified during them is missed
+        self.__watcher = watchTrees(self.args, list(self.__trees))
+
+    def runIt(self) -> None: # Called on start
+        q = self.__watcher.queue
+        while True:
+            (t0, fn) = q.get()
+            q.task_done()
+            for root in self.route(fn): # Never blocks, when full the tree is resynced
+                self.__trees[root].putOrCollapse((t0, fn), (t0, root))
 
 class PushTo(Thread):
-    def __init__(self, dirname:str, targets:tuple, args:ArgumentParser) -> None:
+    def __init__(self, dirname:str, targets:tuple, router:PushRouter,
+                 supervisor:RsyncSupervisor, args:ArgumentParser) -> None:
         Thread.__init__(self, "Push_" + dirname, args)
         self.__dirRoot = os.path.abspath(os.path.expanduser(dirname))
+        self.__rootLen = len(os.path.join(self.__dirRoot, "")) # Strip to get a relative path
         self.__targets = targets
+        self.__queue = router.add(self.__dirRoot)
+        self.__supervisor = supervisor
 
-    def rsyncTo(self, src:str, tgt:str) -> None:
+    def rsyncTo(self, src:str, tgt:str) -> list:
         cmd = (
                 self.args.rsync,
-                "--verbose",
                 "--archive",
+                *transferOptions(self.args),
+                "--rsh", shlex.join(sshCommand(self.args)),
                 "--temp-dir", self.args.cache,
                 "--delete-delay",
                 os.path.join(src, ""), # Add trailing slash
                 tgt,
                 )
-        sp = subprocess.run(
-                cmd,
-                shell=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
+        return [self.__supervisor.execute(cmd)]
+
+    def rsyncBucket(self, files:list, tgt:str, shared:bool=True) -> Future:
+        # Only stat and send the named paths, relative to the root, instead of a whole tree
+        cmd = (
+                self.args.rsync,
+                "--archive",
+                *transferOptions(self.args),
+                "--recursive", # Not implied by --archive with --files-from, needed for new dirs
+                "--files-from=-",
+                "--from0",
+                "--delete-missing-args", # Named paths which no longer exist are deleted
+                "--rsh", shlex.join(sshCommand(self.args, shared)),
+                "--temp-dir", self.args.cache,
+                "--delete-delay",
+                os.path.join(self.__dirRoot, ""), # Add trailing slash
+                tgt,
                 )
-        if sp.stdout:
-            try:
-                sp.stdout = str(sp.stdout, "utf-8")
-            except:
-                pass
-        if sp.returncode:
-            logging.warning("Failed executing %s\n%s", " ".join(sp.args), sp.stdout)
-        elif sp.stdout:
-            logging.info("Executed: %s\n%s", " ".join(sp.args), sp.stdout)
-        else:
-            logging.info("Executed: %s", " ".join(sp.args))
-
-        return sp.returncode == 0
+        return self.__supervisor.execute(cmd, b"\0".join(map(os.fsencode, files)))
+
+    def rsyncFiles(self, files:list, tgt:str) -> list:
+        nStreams = min(self.args.rsyncParallel, len(files))
+        if nStreams <= 1: return [self.rsyncBucket(files, tgt)]
+
+        # Split the files by a hash of their path into disjoint lists, each sent by its own
+        # rsync over its own TCP connection, to fill long fat links
+        buckets = [[] for i in range(nStreams)]
+        for fn in files:
+            buckets[zlib.crc32(os.fsencode(fn)) % nStreams].append(fn)
+        return [self.rsyncBucket(bucket, tgt, False) for bucket in buckets if bucket]
+
+    def rsyncAll(self, func, src) -> list:
+        # Start all the targets at once, so a window costs max(rsync) not sum(rsync)
+        return [future for tgt in self.__targets for future in func(src, tgt)]
 
     def runIt(self) -> None: # Called on start
-        args = self.args
         dirRoot = self.__dirRoot
         targets = self.__targets
         sleepTime = self.args.pushDelay
         logging.info("Starting %s with delay %s", targets, sleepTime)
-        inotify = INotify(args)
-        inotify.start()
-        inotify.addTree(dirRoot)
-        q = inotify.queue
-
-        # Do an initial sync to know where we're starting at
+        q = self.__queue # Fed by the shared PushRouter
 
-        sources = set()
-        sources.add(dirRoot)
-        src = dirRoot
+        changed = PathTrie() # Modified paths, retried until every target has them
 
-        qClearSources = True
-
-        for tgt in targets:
-            if not self.rsyncTo(src, tgt): qClearSources = False
-
-        if qClearSources: sources = set()
+        # Start an initial sync of the whole tree to know where we're starting at.
+        # Like every later window it runs while the next window is collected.
 
+        inFlight = (self.rsyncAll(self.rsyncTo, dirRoot), (dirRoot,)) # (futures, paths)
 
         while True:
             (t0, fn) = q.get()
-            dirname = fn if os.path.isdir(fn) else os.path.dirname(fn)
-            sources.add(dirname)
-            dt = max(t0 - time.time() + sleepTime, 0.1)
-            logging.info("Sleeping for %s seconds due to %s", dt, fn)
-            time.sleep(dt)
-            while not q.empty():
-                (t0, fn) = q.get()
-                dirname = fn if os.path.isdir(fn) else os.path.dirname(fn)
-                sources.add(dirname)
-
-            src = os.path.commonpath(sources) # Common path for all updated files
-            relpath = os.path.relpath(src, start=dirRoot) # Strip off root portion of path
-
-            qClearSources = True
-
-            for tgt in targets:
-                if relpath != ".": tgt = os.path.join(tgt, relpath)
-                if not self.rsyncTo(src, tgt):
-                    qClearSources = False
-
-            if qClearSources: sources = set()
-
             q.task_done()
-
-class MonitorRemote(Thread):
-    def __init__(self, hostname:str, directory:str, args:ArgumentParser) -> None:
-        Thread.__init__(self, "monitor_" + src, args)
+            changed.add(fn)
+            seen = set((fn,)) # Names already in this window, edit storms repeat the same few
+            deadline = max(t0 + sleepTime, time.time() + 0.1)
+            logging.info("Collecting for %s seconds due to %s", deadline - time.time(), fn)
+            while True: # Debounce and drain in one, anything after the deadline is the next window
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                try:
+                    (t0, fn) = q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                q.task_done()
+                if fn in seen: continue # O(1) instead of walking the trie again
+                seen.add(fn)
+                changed.add(fn)
+
+            # Wait for the previous window, so a target never has two of our rsyncs at once,
+            # and send anything it failed to deliver with this window
+            (futures, paths) = inFlight
+            if not all([future.result() for future in futures]):
+                for path in paths: changed.add(path)
+
+            paths = changed.paths()
+            rootLen = self.__rootLen # Events are always under dirRoot, so just slice
+            files = ["." if path == dirRoot else path[rootLen:] for path in paths]
+            inFlight = (self.rsyncAll(self.rsyncFiles, files), paths)
+            changed = PathTrie()
+
+class MonitorRemote:
+    """ One ssh monitor per host, watching every directory pulled from it """
+    def __init__(self, hostname:str, args:ArgumentParser) -> None:
+        self.name = "monitor_" + hostname
+        self.args = args
         self.__hostname = hostname
-        self.__directory = directory
-        self.queue = queue.Queue()
+        self.__queues = {} # Remote directory to the queues of the PullFroms using it
 
-    def runIt(self) -> None: # Called on start
+    def add(self, directory:str) -> BoundedQueue: # Called before run
+        q = BoundedQueue(self.args.queueMax)
+        self.__queues.setdefault(directory, []).append(q)
+        return q
+
+    async def run(self) -> None: # Called from MonitorLoop's event loop
         args = self.args
         hostname = self.__hostname
-        directory = self.__directory
-        q = self.queue
-        logging.info("Starting host %s directory %s", hostname, directory)
+        directories = list(self.__queues) # Records carry an index into this
+        logging.info("Starting host %s directories %s", hostname, directories)
         cmd = (
-                args.ssh,
+                *sshCommand(args),
                 hostname,
                 args.monitorRemote,
                 "--verbose",
                 "--logfile", os.path.abspath(os.path.expanduser("~/logs/monitorRemote.log")),
-                directory,
+                *(("--fanotify",) if args.fanotify else ()),
+                *directories,
                 str(args.pullDelay)
                 )
 
         for cnt in range(args.retries):
-            with subprocess.Popen(cmd, 
-                                  shell=False, 
-                                  stdout=subprocess.PIPE, 
-                                  stderr=subprocess.STDOUT,) as proc:
+            proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, # Keep ssh's complaints out of the records
+                    )
+            stderr = asyncio.create_task(self.__logStderr(proc.stderr))
+            try:
                 while True:
-                    line = proc.stdout.readline()
-                    if not line: break
-                    matches = re.match(b"^:(.+)\s+$", line)
-                    if not matches:
-                        logging.info("unmatched line %s", line)
-                        continue
-                    try:
-                        fn = str(matches[1], "utf-8")
-                    except:
-                        fn = matches[1]
-
-                    logging.info("Sending %s", fn)
-                    q.put(fn)
+                    (index, n) = RECORD.unpack(await proc.stdout.readexactly(RECORD.size))
+                    if n > MAX_RECORD or index >= len(directories):
+                        logging.warning("Record %s/%s from %s, reconnecting", index, n, hostname)
+                        proc.kill()
+                        break
+                    # Always queue a str, undecodable bytes round trip through surrogateescape
+                    fn = (await proc.stdout.readexactly(n)).decode("utf-8", "surrogateescape")
+                    logging.info("Sending %s %s", directories[index], fn)
+                    for q in self.__queues[directories[index]]:
+                        q.putOrCollapse(fn, ".") # When full pull the whole directory
+            except asyncio.IncompleteReadError:
+                pass # The connection went away
+            await proc.wait()
+            await stderr
 
             logging.info("Retry %s/%s sleeping for %s", cnt, args.retries, args.retrySleep)
-            time.sleep(args.retrySleep)
-        raise Exception("Fell through on monitor remote")
+            await asyncio.sleep(args.retrySleep)
+        raise Exception("Fell through on monitor remote " + self.name)
+
+    async def __logStderr(self, stream:asyncio.StreamReader) -> None:
+        async for line in stream:
+            logging.warning("%s %s", self.name, str(line, "utf-8", "replace").rstrip())
+
+class MonitorLoop(Thread):
+    """ Run all the MonitorRemote streams on one asyncio event loop in one thread """
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.__init__(self, "MonitorLoop", args)
+        self.__monitors = {} # Hostname to its MonitorRemote
+
+    def add(self, hostname:str, directory:str) -> BoundedQueue: # Called before start
+        if hostname not in self.__monitors:
+            self.__monitors[hostname] = MonitorRemote(hostname, self.args)
+        return self.__monitors[hostname].add(directory)
+
+    async def __main(self) -> None:
+        await asyncio.gather(*[monitor.run() for monitor in self.__monitors.values()])
+
+    def runIt(self) -> None: # Called on start
+        asyncio.run(self.__main())
 
 class PullFrom(Thread):
-    def __init__(self, dirname:str, src:str, args:ArgumentParser) -> None:
+    def __init__(self, dirname:str, src:str, semaphore:threading.Semaphore,
+                 monitors:MonitorLoop, supervisor:RsyncSupervisor,
+                 args:ArgumentParser) -> None:
         Thread.__init__(self, "Pull_" + dirname, args)
         self.__dirRoot = os.path.abspath(os.path.expanduser(dirname))
         self.__source = src
+        self.__semaphore = semaphore # Shared by all PullFrom threads to bound concurrent rsyncs
+        (hostname, directory) = src.split(":", 1)
+        self.__queue = monitors.add(hostname, directory) # Shares one ssh per host
+        self.__supervisor = supervisor
 
     def rsyncFrom(self, src:str, tgt:str) -> bool:
         cmd = (
                 self.args.rsync,
-                "--verbose",
                 "--archive",
+                *transferOptions(self.args),
+                "--rsh", shlex.join(sshCommand(self.args)),
                 "--temp-dir", os.path.abspath(os.path.expanduser(self.args.cache)),
                 "--delete-delay",
                 os.path.join(src, ""), # Add trailing slash
                 tgt,
                 )
-        sp = subprocess.run(
-                cmd,
-                shell=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
+        with self.__semaphore:
+            return self.__supervisor.execute(cmd).result()
+
+    def rsyncFiles(self, files:list) -> bool:
+        # Only stat and pull the named paths, relative to the directory, in one rsync
+        cmd = (
+                self.args.rsync,
+                "--archive",
+                *transferOptions(self.args),
+                "--recursive", # Not implied by --archive with --files-from, needed for new dirs
+                "--files-from=-",
+                "--from0",
+                "--delete-missing-args", # Named paths which no longer exist are deleted
+                "--rsh", shlex.join(sshCommand(self.args)),
+                "--temp-dir", os.path.abspath(os.path.expanduser(self.args.cache)),
+                "--delete-delay",
+                os.path.join(self.__source, ""), # Add trailing slash
+                self.__dirRoot,
                 )
-        if sp.stdout:
-            try:
-                sp.stdout = str(sp.stdout, "utf-8")
-            except:
-                pass
-        if sp.returncode:
-            logging.warning("Failed executing %s\n%s", " ".join(sp.args), sp.stdout)
-        elif sp.stdout:
-            logging.info("Executed: %s\n%s", " ".join(sp.args), sp.stdout)
-        else:
-            logging.info("Executed: %s", " ".join(sp.args))
-
-        return sp.returncode == 0
+        with self.__semaphore:
+            return self.__supervisor.execute(cmd, b"\0".join(map(os.fsencode, files))).result()
 
     def runIt(self) -> None: # Called on start
-        args = self.args
         tgt = self.__dirRoot
         src = self.__source
-        (hostname, directory) = src.split(":", 1)
         sleepTime = self.args.pullDelay
         logging.info("Starting tgt %s src %s with delay %s", tgt, src, sleepTime)
 
-        monitor = MonitorRemote(hostname, directory, args)
-        monitor.start()
-        q = monitor.queue
+        q = self.__queue
+        tgtLen = len(os.path.join(tgt, "")) # Strip to get a relative path
 
         self.rsyncFrom(src, tgt) # Do an initial sync to know where we're starting at
 
+        changed = PathTrie() # Modified paths, retried until a pull delivers them
         while True:
-            path = q.get()
+            path = q.get() # Always a str relative to directory
             q.task_done()
-            if path is None: continue
-            try:
-                if not isinstance(path, str):
-                    path = str(path, "UTF-8")
-                if path == ".":
-                    srcPath = directory
-                    tgtPath = tgt
-                else:
-                    srcPath = os.path.join(directory, path)
-                    tgtPath = os.path.join(tgt, path)
-                srcPath = hostname + ":" + srcPath
-                self.rsyncFrom(srcPath, tgtPath)
-            except:
-                logging.exception("Unable to convert %s to str", path)
+            changed.add(os.path.join(tgt, path))
+            while True: # The monitor already debounced, so take the rest of its window
+                try:
+                    path = q.get_nowait()
+                except queue.Empty:
+                    break
+                q.task_done()
+                changed.add(os.path.join(tgt, path))
+
+            files = ["." if path == tgt else path[tgtLen:] for path in changed.paths()]
+            if self.rsyncFiles(files): changed = PathTrie()
 
 parser = ArgumentParser()
 Logger.addArgs(parser)
@@ -226,10 +333,23 @@ parser.add_argument("--config", type=str, default="config.yaml", help="YAML conf
 grp = parser.add_argument_group(description="Push related options")
 grp.add_argument("--pushDelay", type=float, default=20,
                     help="Seconds to delay pushing after a file has been modified.")
+grp.add_argument("--rsyncMax", type=int, default=8,
+                 help="Maximum number of push and pull rsyncs running at the same time")
+grp.add_argument("--rsyncParallel", type=int, default=1,
+                 help="Parallel rsync streams per target, for high latency links")
 grp = parser.add_argument_group(description="Pull related options")
 grp.add_argument("--pullDelay", type=float, default=20,
                     help="Seconds between attempts to pull from host")
-grp.add_argument("--bwlimit", type=str, help="Rsync --bw-limit RATE argument")
+grp.add_argument("--pullParallel", type=int, default=2,
+                 help="Maximum number of pull rsyncs running at the same time")
+grp = parser.add_argument_group(description="Rsync transfer related options")
+grp.add_argument("--bwlimit", type=str, help="Rsync --bwlimit RATE argument")
+grp.add_argument("--compress", type=str, default="",
+                 help="Rsync --compress-choice, e.g. zstd, needs rsync >= 3.2 on both ends")
+grp.add_argument("--compressLevel", type=int, default=3, help="Rsync --compress-level")
+grp.add_argument("--inplace", action="store_true",
+                 help="Rsync --inplace, update files in place instead of via --temp-dir,"
+                 " an interrupted transfer leaves a truncated file under its real name")
 grp = parser.add_argument_group(description="Remote monitor related options")
 grp.add_argument("--monitorRemote", type=str, 
                  default=os.path.join(os.path.dirname(__file__), "monitorRemote.py"),
@@ -238,16 +358,33 @@ grp.add_argument("--retries", type=int, default=100,
                  help="How many ssh reconnect attempts before throwing an exception")
 grp.add_argument("--retrySleep", type=int, default=600,
                  help="How long to wait between reconnect attempts")
+grp.add_argument("--fanotify", action="store_true",
+                 help="Watch trees with one fanotify filesystem mark, instead of inotify watches")
+grp.add_argument("--queueMax", type=int, default=100000,
+                 help="Events queued per tree before collapsing them into a full resync")
 grp = parser.add_argument_group(description="Path related options")
 grp.add_argument("--ssh", type=str, default="/usr/bin/ssh", help="ssh command to use")
 grp.add_argument("--rsync", type=str, default="/usr/bin/rsync", help="rsync command to use")
 grp.add_argument("--cache", type=str, default="~/.cache", help="rsync --temp-dir")
+grp.add_argument("--controlPath", type=str, default="~/.ssh/cm-%r@%h:%p",
+                 help="ssh ControlPath for sharing connections, empty to disable")
+grp.add_argument("--controlPersist", type=int, default=600,
+                 help="Seconds an idle shared ssh connection stays open")
 args = parser.parse_args()
 
 args.cache = os.path.abspath(os.path.expanduser(args.cache))
+if args.controlPath:
+    args.controlPath = os.path.abspath(os.path.expanduser(args.controlPath))
+    os.makedirs(os.path.dirname(args.controlPath), mode=0o700, exist_ok=True)
 
 Logger.mkLogger(args)
 
+pullSemaphore = threading.BoundedSemaphore(max(1, args.pullParallel))
+monitors = MonitorLoop(args) # Every remote monitor shares one event loop thread
+router = PushRouter(args) # Every push tree shares one watcher
+supervisor = RsyncSupervisor(args) # Every rsync's output is read by one thread
+supervisor.start()
+
 thrds = []
 
 with open(args.config, "r") as fp:
@@ -256,12 +393,15 @@ with open(args.config, "r") as fp:
         item = a[dirname]
         if item is None: continue
         if "pushTo" in item:
-            thrds.append(PushTo(dirname, item["pushTo"], args))
-            thrds[-1].start()
+            thrds.append(PushTo(dirname, item["pushTo"], router, supervisor, args))
         if "pullFrom" in item:
             for src in item["pullFrom"]:
-                thrds.append(PullFrom(dirname, src, args))
-                thrds[-1].start()
+                thrds.append(PullFrom(dirname, src, pullSemaphore, monitors, supervisor, args))
+
+router.watch() # Every push tree is watched before its initial sync starts
+for thrd in thrds: thrd.start()
+router.start()
+monitors.start()
 
 try:
     Thread.waitForException()
@@ -0,0 +1,25 @@
+#
+# Run with: python3 -m unittest
+#
+# The supervisor must survive rsyncs whose children outlive them, e.g. the ssh
+# ControlMaster, so one select can return both the exit and more output.
+
+from argparse import Namespace
+import unittest
+from TPWUtils.Thread import Thread
+from RsyncSupervisor import RsyncSupervisor
+
+class TestRsyncSupervisor(unittest.TestCase):
+    def test_childWritesAfterExit(self) -> None:
+        supervisor = RsyncSupervisor(Namespace(rsyncMax=8, verbose=False, debug=False))
+        supervisor.start()
+        cmd = ("/bin/sh", "-c", "(echo x >&2; echo y >&2) & exit 0")
+        for cnt in range(100):
+            futures = [supervisor.execute(cmd) for i in range(20)]
+            for future in futures:
+                self.assertTrue(future.result(timeout=10))
+        self.assertTrue(supervisor.is_alive())
+        self.assertTrue(Thread.isQueueEmpty())
+
+if __name__ == "__main__":
+    unittest.main()